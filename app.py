@@ -13,16 +13,26 @@ Run with: streamlit run app.py
 """
 
 import streamlit as st
+import streamlit.components.v1 as components
 import pandas as pd
+import numpy as np
 import uuid
 import os
-import base64
+import logging
+import sqlite3
+import threading
+import atexit
+from collections import deque
 from datetime import datetime
-from pathlib import Path
+
+logger = logging.getLogger(__name__)
 
 # Configuration
 IMAGES_CSV = "images.csv"
-VOTES_CSV = "votes.csv"
+VOTES_DB = "votes.db"
+LEGACY_VOTES_CSV = "votes.csv"  # Imported into VOTES_DB on start-up, then renamed
+VOTE_FLUSH_INTERVAL = 2.0  # Seconds buffered votes wait before being written
+VOTE_COLUMNS = ["session_id", "user_name", "image_id", "vote", "timestamp"]
 IMAGES_FOLDER = "images"
 
 # Page config - must be first Streamlit command
@@ -33,6 +43,35 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
+# Keyboard shortcuts - injected into the parent page via components.html
+KEYBOARD_SHORTCUTS_HTML = """
+<script>
+const doc = window.parent.document;
+// The iframe is re-created whenever the voting screen is re-mounted. Keep a
+// single live handler on the parent page: drop the one bound by a previous
+// iframe and bind this one
+if (doc.__brandTinderKeyHandler) {
+    doc.removeEventListener('keydown', doc.__brandTinderKeyHandler);
+}
+doc.__brandTinderKeyHandler = function(e) {
+    // Ignore if user is typing in an input field
+    if (e.target.tagName === 'INPUT' || e.target.tagName === 'TEXTAREA') return;
+
+    const key = e.key.toLowerCase();
+    const buttons = doc.querySelectorAll('button[kind="secondary"], button[kind="primary"]');
+
+    if (key === 'n') {
+        buttons.forEach(b => { if (b.innerText.includes('No')) b.click(); });
+    } else if (key === 'h') {
+        buttons.forEach(b => { if (b.innerText.includes('Maybe')) b.click(); });
+    } else if (key === 'y') {
+        buttons.forEach(b => { if (b.innerText.includes('Yes')) b.click(); });
+    }
+};
+doc.addEventListener('keydown', doc.__brandTinderKeyHandler);
+</script>
+"""
+
 # Custom CSS for cleaner UI
 st.markdown("""
 <style>
@@ -109,15 +148,15 @@ def init_session_state():
         st.session_state.finished = False
     if "started" not in st.session_state:
         st.session_state.started = False
+    if "my_votes" not in st.session_state:
+        st.session_state.my_votes = {}
 
 
-def load_images():
-    """Load images from CSV file."""
-    if not os.path.exists(IMAGES_CSV):
-        return None, "images.csv not found. Please create it with columns: id, url, label"
-    
+@st.cache_data(show_spinner=False)
+def _load_images_cached(path: str, mtime: float):
+    """Parse and normalize the images CSV. Cached per file modification time."""
     try:
-        df = pd.read_csv(IMAGES_CSV)
+        df = pd.read_csv(path)
         required_cols = ["id", "url"]
         if not all(col in df.columns for col in required_cols):
             return None, "images.csv must have 'id' and 'url' columns"
@@ -132,99 +171,240 @@ def load_images():
         # Ensure columns are strings and fill NaNs
         df["url"] = df["url"].fillna("").astype(str).str.strip()
         df["id"] = df["id"].fillna("").astype(str).str.strip()
+        df["label"] = df["label"].fillna("").astype(str).str.strip()
+        df["has_label"] = df["label"] != ""
+        
+        # Resolve the display path/URL once: remote URLs, absolute paths and
+        # paths already inside the images folder are kept, anything else is
+        # relative to it (same rules as os.path.join(IMAGES_FOLDER, url))
+        url = df["url"]
+        is_http = url.str.startswith(("http://", "https://"))
+        is_abs = url.map(os.path.isabs)
+        df["path"] = np.where(
+            is_http | is_abs | url.str.startswith(IMAGES_FOLDER),
+            url,
+            os.path.join(IMAGES_FOLDER, "") + url
+        )
         
         return df, None
     except Exception as e:
         return None, f"Error loading images.csv: {str(e)}"
 
 
-def get_image_path(url: str) -> str:
-    """Get the proper image path/URL."""
-    if pd.isna(url) or not isinstance(url, str):
-        return ""
+def load_images():
+    """Load images from CSV file."""
+    if not os.path.exists(IMAGES_CSV):
+        return None, "images.csv not found. Please create it with columns: id, url, label"
     
-    if url.startswith(("http://", "https://")):
-        return url
-    # Local file - check in images folder
-    return os.path.join(IMAGES_FOLDER, url) if not url.startswith(IMAGES_FOLDER) else url
+    # Pass the mtime so edits to images.csv invalidate the cache
+    return _load_images_cached(IMAGES_CSV, os.path.getmtime(IMAGES_CSV))
+
+
+@st.cache_resource
+def get_votes_db():
+    """Get the SQLite votes database shared by all sessions.
+    
+    Returns the connection, a lock and the buffer of votes waiting to be
+    flushed. Streamlit serves sessions from multiple threads and they all
+    share this one connection, so every access goes through the lock.
+    """
+    conn = sqlite3.connect(VOTES_DB, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS votes (
+            session_id TEXT NOT NULL,
+            user_name TEXT,
+            image_id TEXT NOT NULL,
+            vote TEXT NOT NULL,
+            timestamp TEXT,
+            UNIQUE (session_id, image_id)
+        )
+    """)
+    # Covering index for both end-screen queries: the per-image GROUP BY walks it
+    # in image_id order (no temp b-tree, no table lookups) and unique-voter
+    # counts for a set of images are answered from it directly
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_votes_image ON votes (image_id, session_id, vote)")
+    
+    # One-time import of votes collected before the SQLite store existed
+    # (INSERT OR IGNORE keeps newer votes, so a failed import is retried on the next start)
+    if os.path.exists(LEGACY_VOTES_CSV):
+        try:
+            legacy_df = pd.read_csv(LEGACY_VOTES_CSV, dtype=str)
+            missing_cols = {"session_id", "image_id", "vote"} - set(legacy_df.columns)
+            if missing_cols:
+                raise ValueError(f"missing required columns: {sorted(missing_cols)}")
+            # Missing optional columns (user_name, timestamp) become NULL
+            legacy_df = legacy_df.reindex(columns=VOTE_COLUMNS)
+            legacy_df = legacy_df.dropna(subset=["session_id", "image_id", "vote"])
+            legacy_df["image_id"] = legacy_df["image_id"].str.strip()
+            rows = legacy_df.astype(object).where(legacy_df.notna(), None).itertuples(index=False)
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT OR IGNORE INTO votes (session_id, user_name, image_id, vote, timestamp) "
+                "VALUES (?, ?, ?, ?, ?)",
+                list(rows)
+            )
+            conn.execute("COMMIT")
+            # Keep the original file around, but never import it twice
+            os.replace(LEGACY_VOTES_CSV, LEGACY_VOTES_CSV + ".imported")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            logger.exception("Could not import legacy votes from %s", LEGACY_VOTES_CSV)
+    
+    votes_db = {"conn": conn, "lock": threading.Lock(), "pending": deque(), "timer": None}
+    # Don't lose buffered votes when the server shuts down
+    atexit.register(flush_votes, votes_db)
+    return votes_db
+
+
+def schedule_flush(votes_db: dict):
+    """Start the background flush timer unless one is already pending.
+    
+    Must be called with the votes_db lock held.
+    """
+    if votes_db["timer"] is None:
+        timer = threading.Timer(VOTE_FLUSH_INTERVAL, flush_votes, args=(votes_db,))
+        timer.daemon = True
+        timer.start()
+        votes_db["timer"] = timer
+
+
+def flush_votes(votes_db: dict) -> bool:
+    """Write all buffered votes to the database in a single transaction.
+    
+    Returns False if the write failed; the votes then stay buffered and
+    another flush is scheduled.
+    """
+    with votes_db["lock"]:
+        votes_db["timer"] = None
+        if not votes_db["pending"]:
+            return True
+        
+        rows = list(votes_db["pending"])
+        votes_db["pending"].clear()
+        conn = votes_db["conn"]
+        try:
+            conn.execute("BEGIN")
+            # The WHERE clause skips the write when the stored vote is unchanged
+            conn.executemany(
+                """
+                INSERT INTO votes (session_id, user_name, image_id, vote, timestamp)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (session_id, image_id)
+                DO UPDATE SET vote = excluded.vote, timestamp = excluded.timestamp
+                WHERE vote != excluded.vote
+                """,
+                rows
+            )
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            logger.exception("Could not write %d buffered votes, retrying", len(rows))
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            # Keep the votes and try again later
+            votes_db["pending"].extendleft(reversed(rows))
+            schedule_flush(votes_db)
+            return False
 
 
-def load_votes():
-    """Load existing votes from CSV."""
-    if not os.path.exists(VOTES_CSV):
-        return pd.DataFrame(columns=["session_id", "user_name", "image_id", "vote", "timestamp"])
-    
-    try:
-        df = pd.read_csv(VOTES_CSV)
-        # Ensure image_id is string to match images_df
-        if "image_id" in df.columns:
-            df["image_id"] = df["image_id"].astype(str).str.strip()
-        return df
-    except Exception:
-        return pd.DataFrame(columns=["session_id", "user_name", "image_id", "vote", "timestamp"])
+def query_votes(sql: str, params=()) -> pd.DataFrame:
+    """Run a read query against the votes database."""
+    votes_db = get_votes_db()
+    # Make sure buffered votes are visible to the query. A failed flush is
+    # logged and retried in the background - still answer from what's stored.
+    flush_votes(votes_db)
+    with votes_db["lock"]:
+        return pd.read_sql_query(sql, votes_db["conn"], params=params)
+
+
+def count_votes() -> int:
+    """Count all votes cast so far."""
+    return int(query_votes("SELECT COUNT(*) AS n FROM votes")["n"].iloc[0])
 
 
 def save_vote(session_id: str, user_name: str, image_id: str, vote: str):
     """Save or update a vote."""
-    timestamp = datetime.now().isoformat()
-    votes_df = load_votes()
+    # Same vote as before (e.g. a double click) - nothing to write
+    my_votes = st.session_state.setdefault("my_votes", {})
+    if my_votes.get((session_id, image_id)) == vote:
+        return
     
-    # Check for existing vote from this session for this image
-    mask = (votes_df["session_id"] == session_id) & (votes_df["image_id"] == image_id)
+    timestamp = datetime.now().isoformat()
+    votes_db = get_votes_db()
     
-    if mask.any():
-        # Update existing vote
-        votes_df.loc[mask, "vote"] = vote
-        votes_df.loc[mask, "timestamp"] = timestamp
-    else:
-        # Add new vote
-        new_vote = pd.DataFrame([{
-            "session_id": session_id,
-            "user_name": user_name,
-            "image_id": image_id,
-            "vote": vote,
-            "timestamp": timestamp
-        }])
-        votes_df = pd.concat([votes_df, new_vote], ignore_index=True)
+    # Buffer the vote and let a background timer write the batch
+    with votes_db["lock"]:
+        votes_db["pending"].append((session_id, user_name, image_id, vote, timestamp))
+        schedule_flush(votes_db)
     
-    # Save to CSV
-    votes_df.to_csv(VOTES_CSV, index=False)
+    my_votes[(session_id, image_id)] = vote
+
+
+def clear_votes() -> int:
+    """Delete all votes and return how many were removed."""
+    votes_db = get_votes_db()
+    with votes_db["lock"]:
+        discarded = len(votes_db["pending"])
+        votes_db["pending"].clear()
+        return discarded + votes_db["conn"].execute("DELETE FROM votes").rowcount
 
 
 def get_user_vote_summary(session_id: str):
     """Get vote summary for current user."""
-    votes_df = load_votes()
-    user_votes = votes_df[votes_df["session_id"] == session_id]
+    counts_df = query_votes(
+        "SELECT vote, COUNT(*) AS n FROM votes WHERE session_id = ? GROUP BY vote",
+        (session_id,)
+    )
+    counts = dict(zip(counts_df["vote"], counts_df["n"]))
     
     summary = {
-        "total": len(user_votes),
-        "yes": len(user_votes[user_votes["vote"] == "yes"]),
-        "no": len(user_votes[user_votes["vote"] == "no"]),
-        "maybe": len(user_votes[user_votes["vote"] == "maybe"])
+        "total": int(sum(counts.values())),
+        "yes": int(counts.get("yes", 0)),
+        "no": int(counts.get("no", 0)),
+        "maybe": int(counts.get("maybe", 0))
     }
     return summary
 
 
+def count_unique_voters(image_ids: list) -> int:
+    """Count distinct sessions that voted on any of the given images."""
+    if not image_ids:
+        return 0
+    placeholders = ", ".join("?" * len(image_ids))
+    result = query_votes(
+        f"SELECT COUNT(DISTINCT session_id) AS n FROM votes WHERE image_id IN ({placeholders})",
+        tuple(image_ids)
+    )
+    return int(result["n"].iloc[0])
+
+
 def get_aggregate_stats():
     """Get aggregate statistics across all users."""
-    votes_df = load_votes()
-    
-    if len(votes_df) == 0:
+    # Per-image counts are computed by SQLite in a single pass
+    stats = query_votes("""
+        SELECT
+            image_id,
+            COUNT(*) AS total_votes,
+            SUM(vote = 'yes') AS yes_votes,
+            SUM(vote = 'no') AS no_votes,
+            SUM(vote = 'maybe') AS maybe_votes
+        FROM votes
+        GROUP BY image_id
+    """)
+    
+    if len(stats) == 0:
         return None
     
     # Calculate yes percentage for each image
-    stats = votes_df.groupby("image_id").agg(
-        total_votes=("vote", "count"),
-        yes_votes=("vote", lambda x: (x == "yes").sum()),
-        no_votes=("vote", lambda x: (x == "no").sum()),
-        maybe_votes=("vote", lambda x: (x == "maybe").sum())
-    ).reset_index()
-    
     stats["yes_percentage"] = (stats["yes_votes"] / stats["total_votes"] * 100).round(1)
     # Weighted score: yes_percentage * log(total_votes + 1) to balance approval rate with sample size
-    import numpy as np
     stats["weighted_score"] = stats["yes_percentage"] * np.log1p(stats["total_votes"])
-    stats = stats.sort_values(["weighted_score", "yes_percentage"], ascending=[False, False])
+    stats = stats.sort_values(
+        ["weighted_score", "yes_percentage", "image_id"],
+        ascending=[False, False, True]
+    )
     
     return stats
 
@@ -236,6 +416,7 @@ def reset_session():
     st.session_state.current_index = 0
     st.session_state.finished = False
     st.session_state.started = False
+    st.session_state.my_votes = {}
 
 
 def show_intro_screen():
@@ -279,24 +460,19 @@ def show_intro_screen():
                 st.error("Please enter your name or alias to continue.")
 
 
+def is_video_file(file_path: str) -> bool:
+    """Check whether a path points to a video."""
+    return file_path.lower().endswith(('.mp4', '.mov', '.webm'))
+
+
 def render_media_content(file_path: str):
     """Helper to render image or video content."""
-    is_video = file_path.lower().endswith(('.mp4', '.mov', '.webm'))
-    
     try:
-        if is_video:
-            if os.path.exists(file_path):
-                with open(file_path, "rb") as f:
-                    video_bytes = f.read()
-                    video_b64 = base64.b64encode(video_bytes).decode()
-                    
-                video_html = f"""
-                    <video width="100%" autoplay loop muted playsinline style="border-radius: 5px;">
-                        <source src="data:video/mp4;base64,{video_b64}" type="video/mp4">
-                        Your browser does not support the video tag.
-                    </video>
-                """
-                st.markdown(video_html, unsafe_allow_html=True)
+        if is_video_file(file_path):
+            if file_path.startswith(("http://", "https://")) or os.path.exists(file_path):
+                # Served by Streamlit's media endpoint with Range support -
+                # no base64 encoding and the bytes stay out of the page
+                st.video(file_path, autoplay=True, loop=True, muted=True)
                 return True
             else:
                  st.error(f"Video file not found: {file_path}")
@@ -331,13 +507,12 @@ def show_voting_screen(images_df: pd.DataFrame):
     )
     
     # Display image or video
-    file_path = get_image_path(current_image["url"])
+    file_path = current_image["path"]
     content_loaded = render_media_content(file_path)
     
     # Show label if present
-    label = current_image.get("label", "")
-    if pd.notna(label) and str(label).strip():
-        st.markdown(f'<p class="image-label">{label}</p>', unsafe_allow_html=True)
+    if current_image["has_label"]:
+        st.markdown(f'<p class="image-label">{current_image["label"]}</p>', unsafe_allow_html=True)
     
     st.markdown("")
     
@@ -374,27 +549,7 @@ def show_voting_screen(images_df: pd.DataFrame):
             st.rerun()
     
     # Keyboard shortcut handler using components.html for JS execution
-    import streamlit.components.v1 as components
-    components.html("""
-    <script>
-    const doc = window.parent.document;
-    doc.addEventListener('keydown', function(e) {
-        // Ignore if user is typing in an input field
-        if (e.target.tagName === 'INPUT' || e.target.tagName === 'TEXTAREA') return;
-
-        const key = e.key.toLowerCase();
-        const buttons = doc.querySelectorAll('button[kind="secondary"], button[kind="primary"]');
-
-        if (key === 'n') {
-            buttons.forEach(b => { if (b.innerText.includes('No')) b.click(); });
-        } else if (key === 'h') {
-            buttons.forEach(b => { if (b.innerText.includes('Maybe')) b.click(); });
-        } else if (key === 'y') {
-            buttons.forEach(b => { if (b.innerText.includes('Yes')) b.click(); });
-        }
-    });
-    </script>
-    """, height=0)
+    components.html(KEYBOARD_SHORTCUTS_HTML, height=0)
 
     # Keyboard hints
     st.markdown(
@@ -472,7 +627,7 @@ def show_end_screen(images_df: pd.DataFrame):
         # Merge with image labels
         # Use inner join to exclude votes for images that no longer exist in the deck
         agg_stats = agg_stats.merge(
-            images_df[["id", "url", "label"]], 
+            images_df[["id", "url", "path", "label", "has_label"]], 
             left_on="image_id", 
             right_on="id", 
             how="inner"
@@ -485,22 +640,22 @@ def show_end_screen(images_df: pd.DataFrame):
         
         # Display top results as an interactive list
         for rank, (_, row) in enumerate(top_images.iterrows(), start=1):
-            label_text = row['label'] if pd.notna(row['label']) and str(row['label']).strip() else row['image_id']
+            label_text = row['label'] if row['has_label'] else row['image_id']
             score = f"{row['yes_percentage']}% Yes ({row['total_votes']} votes)"
 
             with st.expander(f"#{rank} {label_text} — {score}"):
-                file_path = get_image_path(row['url'])
-                render_media_content(file_path)
+                file_path = row['path']
+                # Videos are only registered with the media server and played when asked for
+                if not is_video_file(file_path) or st.toggle("▶️ Load video", key=f"load_video_{row['image_id']}"):
+                    render_media_content(file_path)
                 st.caption(f"Votes: {int(row['yes_votes'])} Yes, {int(row['no_votes'])} No, {int(row['maybe_votes'])} Maybe")
         
         # Total stats
         total_votes = agg_stats["total_votes"].sum()
         
         # Get unique voters only for the valid votes
-        valid_image_ids = set(agg_stats["id"])
-        all_votes = load_votes()
-        valid_votes = all_votes[all_votes["image_id"].isin(valid_image_ids)]
-        unique_voters = valid_votes["session_id"].nunique()
+        valid_image_ids = agg_stats["id"].tolist()
+        unique_voters = count_unique_voters(valid_image_ids)
         
         st.markdown("---")
         col1, col2 = st.columns(2)
@@ -567,19 +722,19 @@ def main():
                     st.rerun()
 
                 if st.button("🗑️ Clear All Votes", type="primary"):
-                    if os.path.exists(VOTES_CSV):
-                        try:
-                            os.remove(VOTES_CSV)
+                    try:
+                        st.session_state.my_votes = {}
+                        if clear_votes() > 0:
                             st.toast("Votes database deleted!", icon="🗑️")
                             # Force reload
                             st.rerun()
-                        except Exception as e:
-                            st.error(f"Error: {e}")
-                    else:
-                        st.info("No votes found to delete.")
+                        else:
+                            st.info("No votes found to delete.")
+                    except Exception as e:
+                        st.error(f"Error: {e}")
                 
                 st.markdown("---")
-                st.caption(f"Current Votes: {len(load_votes())}")
+                st.caption(f"Current Votes: {count_votes()}")
 
 
 if __name__ == "__main__":